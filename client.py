@@ -1,41 +1,46 @@
+import logging
 import os
-import re
+import random
 import subprocess
 import sys
 import threading
 import time
 import socket
+from typing import Optional
 
 import msgpack
 import numpy as np
-from netstring import decode
 
 from options import Options, VALID_CHANNELS
-from util import get_mesh_freq, run_command, read_file, write_file, is_process_running, get_ipv6_addr, map_freq_to_channel
+from util import FRAME_HEADER, FREQ_RE, get_mesh_freq, run_command, read_file, write_file, is_process_running, get_ipv6_addr, map_freq_to_channel
 
 
-action_to_id = {
-    "switch_frequency": 0
-}
-id_to_action = {v: k for k, v in action_to_id.items()}
+logger = logging.getLogger(__name__)
+
+# Actions indexed by their id, must match action_to_id in server.py
+ACTIONS = ("switch_frequency",)
+
+# MessagePack decoding options, arrays are decoded as tuples
+UNPACK_KW = {'raw': False, 'use_list': False}
 
 
 class Client:
-    def __init__(self, node_id: str, host: str, port: int) -> None:
+    def __init__(self, node_id: str, host: str, port: int, args: Options) -> None:
         self.node_id = node_id
         self.host = host
         self.port = port
 
         # Initialize server objects
-        self.args = Options()
+        self.args = args
 
         # Internal variables
-        self.current_frequency: int = get_mesh_freq()
+        self.current_frequency: int = np.nan
         self.valid_scan_data: bool = False
         self.target_frequency: int = np.nan
         self.freq_quality: dict = {}
         self.best_freq: int = np.nan
         self.healing_process_id: str = ''
+        self._wpa_conf_cache: Optional[str] = None
 
         # Time for periodic events' variables (in seconds)
         self.time_last_scan: float = 0
@@ -43,90 +48,148 @@ class Client:
 
         # Create listen and client run FSM threads
         self.running = False
-        self.listen_thread = threading.Thread(target=self.receive_messages)
-        self.switching_event = threading.Event()
+        self.listen_thread = threading.Thread(target=self.receive_messages, daemon=True)
+        self._switch_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        # Message handlers indexed by action id, resolved as handle_<action> for each entry of ACTIONS
+        self._handlers = tuple(getattr(self, f'handle_{action}') for action in ACTIONS)
 
         self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        # Deliver small control messages without Nagle delay, absorb bursts and detect a dead orchestrator
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # Preallocated receive buffer, filled in place by recv_into
+        self._rxbuf = bytearray(65536)
+        self._rxview = memoryview(self._rxbuf)
 
     def run(self) -> None:
         """
         Connect to the orchestrator node and start the client's operation in separate threads for running the FSM and receiving messages.
         """
         self.running = True
+        self.current_frequency = get_mesh_freq(self.args.mesh_interface)
         self.connect_to_orchestrator()
         self.listen_thread.start()
 
     def connect_to_orchestrator(self) -> None:
         """
-        Connect to orchestrator via OSF.
+        Connect to orchestrator via OSF, retrying with exponential backoff.
         """
-        max_retries: int = 3
+        delay: float = 0.25
         number_retries: int = 0
-        while number_retries < max_retries:
+        while True:
             try:
                 self.socket.connect((self.host, self.port))
                 break
             except ConnectionRefusedError:
                 number_retries += 1
-                print(f"OSF server connection failed... retry #{number_retries}") if self.args.debug else None
+                logger.debug("OSF server connection failed... retry #%d", number_retries)
 
-            if number_retries == max_retries:
+            if number_retries == self.args.max_connect_retries:
                 sys.exit("OSF Server unreachable")
 
-            time.sleep(3)
+            # Wait before retrying, doubling the delay up to 5 s, and give up waiting if the client is stopped
+            if self._stop_event.wait(delay + random.uniform(0, 0.1)):
+                return
+            delay = min(delay * 2, 5.0)
 
     def receive_messages(self) -> None:
         """
         Receive incoming messages from the orchestrator.
         """
+        # Unconsumed data lives in self._rxbuf[head:tail]
+        head: int = 0
+        tail: int = 0
         while self.running:
             try:
-                # Receive incoming messages and decode the netstring encoded data
-                try:
-                    data = decode(self.socket.recv(1024))
-                    if not data:
-                        print("No data... break") if self.args.debug else None
+                # Move pending bytes to the front once the consumed prefix is large or the buffer is full
+                if head > 32768 or tail == len(self._rxbuf):
+                    if head == 0:
+                        logger.debug("Incoming message exceeds receive buffer... break")
                         break
-                except Exception as e:
-                    # Handle netstring decoding errors
-                    print(f"Failed to decode netstring: {e}") if self.args.debug else None
+                    self._rxbuf[:tail - head] = self._rxbuf[head:tail]
+                    tail -= head
+                    head = 0
+
+                # Receive incoming data directly into the buffer
+                received = self.socket.recv_into(self._rxview[tail:])
+                if not received:
+                    logger.debug("No data... break")
                     break
+                tail += received
+
+                # Decode every complete frame (length header followed by the payload) available in the buffer
+                while tail - head >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(self._rxbuf, head)
+                    start = head + FRAME_HEADER.size
+                    if start + length > tail:
+                        break
+                    self.process_message(self._rxview[start:start + length])
+                    head = start + length
 
-                # Deserialize the MessagePack message
-                try:
-                    unpacked_data = msgpack.unpackb(data, raw=False)
-                    action_id: int = unpacked_data.get("a_id")
-                    action_str: str = id_to_action.get(action_id)
-                    print(f"Received message: {unpacked_data}") if self.args.debug else None
-
-                    # Handle frequency switch request
-                    if action_str == "switch_frequency":
-                        received_target_freq = unpacked_data.get("freq")
-                        self.update_target_freq(received_target_freq)
-                        if self.current_frequency != self.target_frequency and not self.switching_event.is_set():
-                            self.switching_event.set()
-                            self.switch_frequency()
-                            self.switching_event.clear()
-
-                except msgpack.UnpackException as e:
-                    print(f"Failed to decode MessagePack: {e}") if self.args.debug else None
-                    continue
-
-                except Exception as e:
-                    print(f"Error in received message: {e}") if self.args.debug else None
-                    continue
+                if head == tail:
+                    head = tail = 0
 
             except ConnectionResetError:
-                print("Connection forcibly closed by the remote host") if self.args.debug else None
+                logger.debug("Connection forcibly closed by the remote host")
                 break
 
+    def process_message(self, data: memoryview) -> None:
+        """
+        Deserialize and handle the message contained in a frame payload.
+
+        :param data: The MessagePack encoded payload of a frame.
+        """
+        # Each frame carries exactly one object, so a truncated or trailing object only fails its own frame
+        try:
+            unpacked_data = msgpack.unpackb(data, **UNPACK_KW)
+        except (msgpack.UnpackException, ValueError) as e:
+            logger.debug("Failed to decode MessagePack: %s", e)
+            return
+        self.dispatch_message(unpacked_data)
+
+    def dispatch_message(self, unpacked_data: dict) -> None:
+        """
+        Handle a single message received from the orchestrator.
+
+        :param unpacked_data: The deserialized message.
+        """
+        try:
+            action_id: int = unpacked_data.get("a_id")
+            logger.debug("Received message: %s", unpacked_data)
+
+            # Dispatch to the handler of the received action
+            if isinstance(action_id, int) and 0 <= action_id < len(self._handlers):
+                self._handlers[action_id](unpacked_data)
+
+        except Exception as e:
+            logger.debug("Error in received message: %s", e)
+
+    def handle_switch_frequency(self, unpacked_data: dict) -> None:
+        """
+        Handle a frequency switch request from the orchestrator.
+
+        :param unpacked_data: The deserialized switch frequency message.
+        """
+        received_target_freq = unpacked_data.get("freq")
+        self.update_target_freq(received_target_freq)
+        # Only one frequency switch may be in progress at a time
+        if self.current_frequency != self.target_frequency and self._switch_lock.acquire(blocking=False):
+            try:
+                self.switch_frequency()
+            finally:
+                self._switch_lock.release()
+
     def switch_frequency(self) -> None:
         """
         Change the mesh frequency to the target frequency.
         """
         # Initialize switch frequency variables
 
-        print(f"Switching to {self.target_frequency} MHz ...\n") if self.args.debug else None
+        logger.debug("Switching to %s MHz ...", self.target_frequency)
         try:
             # Run commands
             cmd_rmv_ip = "ifconfig " + self.args.mesh_interface + " 0"
@@ -137,55 +200,64 @@ class Client:
             # If wpa_supplicant is running, kill it before restarting
             if is_process_running('wpa_supplicant'):
                 run_command('killall wpa_supplicant', 'Failed to kill wpa_supplicant')
-                time.sleep(10)
+                # Wait up to 10 s for wpa_supplicant to exit, polling with a growing delay
+                deadline = time.monotonic() + 10
+                delay: float = 0.05
+                while time.monotonic() < deadline and is_process_running('wpa_supplicant'):
+                    if self._stop_event.wait(delay):
+                        return
+                    delay = min(delay * 2, 0.5)
 
             # Remove mesh interface file to avoid errors when reinitialize interface
             interface_file = '/var/run/wpa_supplicant/' + self.args.mesh_interface
             if os.path.exists(interface_file):
                 os.remove(interface_file)
 
-            # Read and check wpa supplicant config
-            conf = read_file('/var/run/wpa_supplicant-11s.conf', 'Failed to read wpa supplicant config')
+            # Read and check wpa supplicant config, only the first switch reads it from disk
+            conf = self._wpa_conf_cache
+            if conf is None:
+                conf = read_file('/var/run/wpa_supplicant-11s.conf', 'Failed to read wpa supplicant config')
             if conf is None:
-                print("Error: wpa supplicant config is None. Aborting.") if self.args.debug else None
+                logger.debug("Error: wpa supplicant config is None. Aborting.")
                 return
 
             # Edit wpa supplicant config with new mesh freq
-            conf = re.sub(r'frequency=\d*', f'frequency={self.target_frequency}', conf)
+            new_conf = FREQ_RE.sub(f'frequency={self.target_frequency}', conf)
 
-            # Write edited config back to file
-            write_file('/var/run/wpa_supplicant-11s.conf', conf, 'Failed to write wpa supplicant config')
+            # Write edited config back to file if the frequency changed, the cache always mirrors the file on disk
+            if new_conf == conf or write_file('/var/run/wpa_supplicant-11s.conf', new_conf,
+                                              'Failed to write wpa supplicant config'):
+                self._wpa_conf_cache = new_conf
+            else:
+                self._wpa_conf_cache = conf
 
             # Restart wpa supplicant
             cmd_restart_supplicant = 'wpa_supplicant -Dnl80211 -i' + self.args.mesh_interface + ' -c /var/run/wpa_supplicant-11s.conf -B'
             run_command(cmd_restart_supplicant, 'Failed to restart wpa supplicant')
             time.sleep(4)
-            subprocess.call('iw dev', shell=True)
+            # A single iw dev run serves both the debug log and the frequency check
+            iw_output = subprocess.run(['iw', 'dev'], capture_output=True, text=True, check=False).stdout
+            logger.debug("iw dev output:\n%s", iw_output)
 
             # Validate outcome of switch frequency process
-            self.current_frequency = get_mesh_freq()
+            self.current_frequency = get_mesh_freq(self.args.mesh_interface, iw_output)
             if self.current_frequency != self.target_frequency:
-                print("Switch Unsuccessful") if self.args.debug else None
+                logger.debug("Switch Unsuccessful")
                 self.recovering_switch_error()
             else:
                 self.reset()
         except Exception as e:
-            print(f"Switching frequency error occurred: {str(e)}") if self.args.debug else None
+            logger.debug("Switching frequency error occurred: %s", e)
 
     def recovering_switch_error(self) -> None:
         """
         Handle recovering from a switch error by periodically attempting frequency switching.
         """
+        # Wait for the periodic switch timer, returning early if the client is stopped
+        if self._stop_event.wait(self.args.periodic_recovery_switch):
+            return
         self.time_last_scan = time.time()
-        while self.running:
-            current_time = time.time()
-            # If periodic switch timer ended, switch frequency again
-            if current_time - self.time_last_scan >= self.args.periodic_recovery_switch:
-                self.switch_frequency()
-                self.time_last_scan = current_time
-                break
-
-            time.sleep(0.01)
+        self.switch_frequency()
 
     def reset(self) -> None:
         """
@@ -208,31 +280,39 @@ class Client:
         Stops all threads and closes the socket connection.
         """
         self.running = False
-        # Close socket
+        self._stop_event.set()
+        # Shut down socket to wake up a pending recv in the listen thread
         if self.socket:
-            self.socket.close()
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         # Join listen thread
         if self.listen_thread.is_alive():
-            self.listen_thread.join()
+            self.listen_thread.join(timeout=2.0)
+        # Close socket
+        if self.socket:
+            self.socket.close()
 
 
 def main():
-    args = Options()
+    args = Options().parse_options()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
 
     host: str = args.osf_orchestrator
     port: int = args.port
     node_id: str = get_ipv6_addr('tun0')
 
-    client = Client(node_id, host, port)
+    client = Client(node_id, host, port, args)
     client.run()
 
+    # Block until the listen thread exits or the user interrupts
     try:
-        while True:
-            time.sleep(1)
+        client.listen_thread.join()
     except KeyboardInterrupt:
-        print("Attempting to stop the clients.") if args.debug else None
+        logger.debug("Attempting to stop the clients.")
         client.stop()
-        print("Clients successfully stopped.") if args.debug else None
+        logger.debug("Clients successfully stopped.")
 
 
 if __name__ == '__main__':
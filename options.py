@@ -1,9 +1,23 @@
 import argparse
 
-VALID_CHANNELS = [36, 40, 44, 48, 149, 153, 157, 161]
+VALID_CHANNELS = frozenset({36, 40, 44, 48, 149, 153, 157, 161})
 # Note that DFS channel on the 5 GHz band are removed as they should not be used for communication
 
 
+def str_to_bool(value: str) -> bool:
+    """
+    Convert a command line boolean such as 'True', 'false', 'yes' or '0' to a bool.
+
+    :param value: The command line value.
+    :return: The boolean value.
+    """
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f"Boolean value expected, got '{value}'")
+
+
 class Options:
     def __init__(self):
         self.json_file = 'freq.json'
@@ -15,6 +29,7 @@ class Options:
         self.mesh_interface: str = 'wlp1s0'
         self.debug: bool = True
         self.periodic_recovery_switch: float = 20
+        self.max_connect_retries: int = 10
 
     def parse_options(self) -> 'Options':
         parser = argparse.ArgumentParser(description='Arguments for training.')
@@ -25,9 +40,11 @@ class Options:
         parser.add_argument('--waiting_time', type=int, default=self.waiting_time, help='Time interval in seconds.')
         parser.add_argument('--osf_interface', type=str, default=self.osf_interface, help='OSF interface name.')
         parser.add_argument('--mesh_interface', type=str, default=self.mesh_interface, help='Mesh interface name.')
-        parser.add_argument('--debug', type=bool, default=self.debug, help='Use local random sampling of .csv as scan instead of the actual spectral scan.')
+        parser.add_argument('--debug', type=str_to_bool, default=self.debug, help='Use local random sampling of .csv as scan instead of the actual spectral scan.')
         parser.add_argument('--periodic_recovery_switch', type=float, default=self.periodic_recovery_switch,
                             help='How often to trigger switching channel after channel switch has failed.')
+        parser.add_argument('--max_connect_retries', type=int, default=self.max_connect_retries,
+                            help='Number of attempts to connect to the OSF orchestrator before giving up.')
         args = parser.parse_args()
 
         self.json_file = args.json_file
@@ -39,6 +56,7 @@ class Options:
         self.mesh_interface = args.mesh_interface
         self.debug = args.debug
         self.periodic_recovery_switch = args.periodic_recovery_switch
+        self.max_connect_retries = args.max_connect_retries
 
         return self
 
@@ -1,49 +1,68 @@
+import functools
 import json
 import logging
 import msgpack
+import os
+import selectors
 import signal
 import socket
 import sys
-import threading
 import time
-from typing import List, Tuple
-from netstring import encode
+from typing import Dict, Optional, Tuple
 
 from options import Options
-from util import get_mesh_freq
+from util import FRAME_HEADER, get_mesh_freq, watch_file
+
+logger = logging.getLogger(__name__)
 
 action_to_id = {
     "switch_frequency": 0
 }
 id_to_action = {v: k for k, v in action_to_id.items()}
+SWITCH_FREQUENCY_ID = action_to_id["switch_frequency"]
+
+# Frequency file content once its frequency has been handled
+NULL_FREQ_JSON = json.dumps({"freq": None})
+
+# Reused MessagePack serializer for outgoing messages
+packer = msgpack.Packer(use_bin_type=True)
+
+# Serialized switch frequency message up to its frequency value
+SWITCH_FREQUENCY_PREFIX = (packer.pack_map_header(2) + packer.pack('a_id') + packer.pack(SWITCH_FREQUENCY_ID)
+                           + packer.pack('freq'))
 
 
 class Server:
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, args: Options):
         """
         Initializes the Server object.
 
         :param host: The host address to bind the orchestrator/server to.
         :param port: The port number to bind the orchestrator/server to.
+        :param args: The parsed options, shared with the client twins.
         """
         # Initialize server objects and attributes
         self.running = False
         self.host = host
         self.port = port
         self.serversocket = None
-        self.clients: List[ClientTwin] = []
-        self.args = Options()
-        logging.info("initialized server") if self.args.debug else None
+        self.clients: Dict[int, ClientTwin] = {}
+        self.args = args
+        logger.debug("initialized server")
 
-        # Create threads for server operations
-        self.run_server_thread = threading.Thread(target=self.run_server)
+        # Selector multiplexing the server socket, the client sockets and the frequency file watch
+        self.selector = selectors.DefaultSelector()
+        self.json_watch_fd: Optional[int] = None
+        # Socket pair used by stop() to wake up the selector
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
 
         # Time for periodic events' variables (in seconds)
         self.last_requested_spectrum_data: float = time.time()
         self.last_target_freq_broadcast: float = time.time()
 
         # Internal Attributes
-        self.target_frequency: int = get_mesh_freq()
+        self.target_frequency: int = get_mesh_freq(self.args.mesh_interface)
+        self.json_mtime: int = 0
 
         signal.signal(signal.SIGINT, self.signal_handler)
 
@@ -53,19 +72,21 @@ class Server:
         """
         try:
             self.running = True
-            logging.info("started server") if self.args.debug else None
+            logger.debug("started server")
             self.serversocket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
             self.serversocket.bind((self.host, self.port))
             self.serversocket.listen(5)
-            logging.info("server started and listening") if self.args.debug else None
-            self.run_server_thread.start()
+            self.selector.register(self.serversocket, selectors.EVENT_READ, self.accept_client)
+            self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, self.wake_up)
+
+            # Check the frequency file when it changes, it is polled every second if inotify is not available
+            self.json_watch_fd = watch_file(self.args.json_file)
+            if self.json_watch_fd is not None:
+                self.selector.register(self.json_watch_fd, selectors.EVENT_READ, self.json_file_changed)
+            logger.debug("server started and listening")
             signal.signal(signal.SIGINT, self.signal_handler)
 
-            while self.running:
-                c_socket, c_address = self.serversocket.accept()
-                client = ClientTwin(c_socket, c_address, self.clients, self.host)
-                logging.info(f'New connection {client}') if self.args.debug else None
-                self.clients.append(client)
+            self.run_server()
 
         except ConnectionError as e:
             print(f"Connection error: {e}")
@@ -77,20 +98,20 @@ class Server:
         :param sig: The signal received by the handler.
         :param frame: The current execution frame.
         """
-        logging.info("Attempting to close threads.") if self.args.debug else None
+        logger.debug("Attempting to close threads.")
         if self.clients:
-            for client in self.clients:
-                logging.info(f"joining {client.address}") if self.args.debug else None
+            for client in self.clients.values():
+                logger.debug("joining %s", client.address)
                 client.stop()
 
-            logging.info("threads successfully closed") if self.args.debug else None
+            logger.debug("threads successfully closed")
             sys.exit(0)
 
         self.stop()
 
     def stop(self) -> None:
         """
-        Stop the server by closing the server socket and server fsm thread.
+        Stop the server by closing the server socket and waking up the server fsm loop.
         """
         self.running = False
 
@@ -98,39 +119,155 @@ class Server:
         if self.serversocket:
             self.serversocket.close()
 
-        # Join Server FSM thread
-        if self.run_server_thread.is_alive():
-            self.run_server_thread.join()
+        # Wake up the server fsm loop so it exits
+        self.wakeup_sender.send(b'\0')
 
     def run_server(self) -> None:
         """
-        Run the Server Finite State Machine (FSM) continuously to manage its state transitions and periodic tasks.
+        Run the Server Finite State Machine (FSM) continuously to serve socket events and periodic tasks.
         """
+        # check if freq file populated, if so, trigger switch freq
+        self.check_frequency()
+        next_frequency_check: float = time.monotonic() + 1
         while self.running:
             try:
-                # check if freq file populated, if so, trigger switch freq
-                self.check_frequency()
-                time.sleep(1)
+                # Wait for events, only waking up for the periodic frequency check when the file is not watched
+                timeout = None
+                if self.json_watch_fd is None:
+                    timeout = max(next_frequency_check - time.monotonic(), 0)
+                for key, mask in self.selector.select(timeout):
+                    key.data(mask)
+
+                if self.json_watch_fd is None and time.monotonic() >= next_frequency_check:
+                    self.check_frequency()
+                    next_frequency_check = time.monotonic() + 1
             except Exception as e:
-                logging.info(f"Exception in run_server: {e}") if self.args.debug else None
+                logger.debug("Exception in run_server: %s", e)
+
+        self.selector.close()
+        if self.json_watch_fd is not None:
+            os.close(self.json_watch_fd)
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+
+    def wake_up(self, mask: int) -> None:
+        """
+        Drain the wake up socket, the server fsm loop then checks whether it is still running.
+
+        :param mask: The selector events ready on the wake up socket.
+        """
+        self.wakeup_receiver.recv(1024)
+
+    def json_file_changed(self, mask: int) -> None:
+        """
+        Handle inotify events on the directory of the frequency file and check the file for a new frequency.
+
+        :param mask: The selector events ready on the inotify file descriptor.
+        """
+        # Drain the pending events, check_frequency skips the file if it is not the one that changed
+        try:
+            while os.read(self.json_watch_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.check_frequency()
+
+    def accept_client(self, mask: int) -> None:
+        """
+        Accept an incoming client connection and watch its socket for disconnection.
+
+        :param mask: The selector events ready on the server socket.
+        """
+        c_socket, c_address = self.serversocket.accept()
+        # Send the small control messages without Nagle delay, and never block the loop on a slow client
+        c_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        c_socket.setblocking(False)
+        client = ClientTwin(c_socket, c_address, self.clients, self.host, self.args)
+        logger.debug('New connection %s', client.address)
+        self.clients[c_socket.fileno()] = client
+        self.selector.register(c_socket, selectors.EVENT_READ, functools.partial(self.handle_client, client))
+
+    def handle_client(self, client: "ClientTwin", mask: int) -> None:
+        """
+        Handle the events ready on a client socket.
+
+        :param client: The client whose socket is ready.
+        :param mask: The selector events ready on the client socket.
+        """
+        # Send the data that did not fit in the socket buffer earlier
+        if mask & selectors.EVENT_WRITE:
+            self.flush_client(client)
+
+        # Clients never send data, so a readable socket means they disconnected
+        if mask & selectors.EVENT_READ and client.socket.fileno() in self.clients:
+            try:
+                data = client.socket.recv(1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                logger.debug("Client disconnected: %s", client.address)
+                self.remove_client(client)
+
+    def flush_client(self, client: "ClientTwin") -> None:
+        """
+        Send as much of the pending data of a client as its socket accepts without blocking.
+
+        :param client: The client to send the pending data to.
+        """
+        try:
+            sent = client.socket.send(client.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            logger.debug("Broken pipe error, client disconnected: %s", client.address)
+            self.remove_client(client)
+            return
+        del client.outbox[:sent]
+
+        # Only wait for the socket to become writable while data is pending
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if client.outbox else selectors.EVENT_READ
+        key = self.selector.get_key(client.socket)
+        if key.events != events:
+            self.selector.modify(client.socket, events, key.data)
+
+    def remove_client(self, client: "ClientTwin") -> None:
+        """
+        Stop watching a disconnected client and close its connection.
+
+        :param client: The client to remove.
+        """
+        if self.clients.pop(client.socket.fileno(), None) is not None:
+            self.selector.unregister(client.socket)
+            client.stop()
 
     def check_frequency(self) -> None:
         """
         Checks if frequency is populated in the JSON file and trigger switch frequency.
         """
         try:
-            # Load json file to check if there is freq update
+            # Skip loading the json file if it has not been modified since the last check
+            json_mtime = os.stat(self.args.json_file).st_mtime_ns
+            if json_mtime == self.json_mtime:
+                return
+
+            # Load json file to check if there is freq update, a partially written file is loaded again on the next check
             with open(self.args.json_file, 'r') as file:
                 data = json.load(file)
-                if 'freq' in data and data['freq'] is not None:
-                    if isinstance(data['freq'], int):
-                        # Set target frequency
-                        self.target_frequency = data['freq']
-                        # Send switch frequency message to clients
-                        self.send_switch_frequency_message()
-
-                # Revert freq back to null
-                json.dump({"freq": None}, open(self.args.json_file, 'w'))
+            self.json_mtime = json_mtime
+            if 'freq' in data and data['freq'] is not None:
+                if isinstance(data['freq'], int):
+                    # Set target frequency
+                    self.target_frequency = data['freq']
+                    # Send switch frequency message to clients
+                    self.send_switch_frequency_message()
+
+                # Revert freq back to null, the mtime is taken from our own descriptor so a concurrent write is not skipped
+                with open(self.args.json_file, 'w') as file:
+                    file.write(NULL_FREQ_JSON)
+                    file.flush()
+                    self.json_mtime = os.fstat(file.fileno()).st_mtime_ns
 
         # Capture any exceptions with opening and loading json file
         except FileNotFoundError:
@@ -146,31 +283,42 @@ class Server:
 
         :param data: The message to send to the clients.
         """
-        for client in self.clients:
-            try:
-                serialized_data = msgpack.packb(data)
-                netstring_data = encode(serialized_data)
-                client.socket.sendall(netstring_data)
-            except BrokenPipeError:
-                logging.info("Broken pipe error, client disconnected:", client.address) if self.args.debug else None
-                self.clients.remove(client)
+        self.send_payload_clients(packer.pack(data))
+
+    def send_payload_clients(self, payload: bytes) -> None:
+        """
+        Sends an already serialized MessagePack message to all connected clients.
+
+        :param payload: The serialized message to send to the clients.
+        """
+        # Frame once and queue the same bytes for every client
+        frame = FRAME_HEADER.pack(len(payload)) + payload
+        for client in list(self.clients.values()):
+            pending = bool(client.outbox)
+            client.outbox += frame
+            # Clients with pending data are flushed once their socket is writable, keeping messages in order
+            if not pending:
+                self.flush_client(client)
 
     def send_switch_frequency_message(self) -> None:
         """
         Sends a message to all connected clients to switch to target frequency.
         """
-        action_id = action_to_id["switch_frequency"]
-        switch_frequency_data = {'a_id': action_id, 'freq': self.target_frequency}
-        self.send_data_clients(switch_frequency_data)
+        # Only the frequency is packed per message, the rest of {'a_id': ..., 'freq': ...} is prebuilt
+        self.send_payload_clients(SWITCH_FREQUENCY_PREFIX + packer.pack(self.target_frequency))
 
 
 class ClientTwin:
-    def __init__(self, socket: socket.socket, address: Tuple[str, int], clients: List["ClientTwin"], host: str) -> None:
+    def __init__(self, socket: socket.socket, address: Tuple[str, int], clients: Dict[int, "ClientTwin"], host: str,
+                 args: Options) -> None:
         self.socket = socket
         self.address = address
         self.clients = clients
         self.host = host
-        self.args = Options()
+        self.args = args
+
+        # Data waiting to be sent once the socket is writable
+        self.outbox = bytearray()
 
     def stop(self) -> None:
         """
@@ -182,11 +330,12 @@ class ClientTwin:
 
 
 def main():
-    args = Options()
+    args = Options().parse_options()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
 
     host: str = args.osf_orchestrator
     port: int = args.port
-    server: Server = Server(host, port)
+    server: Server = Server(host, port, args)
     server.start()
 
 
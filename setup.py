@@ -1,7 +1,7 @@
+import logging
 import subprocess
 import netifaces
 import os
-import re
 import sys
 import time
 import numpy as np
@@ -58,7 +58,7 @@ def switch_frequency(args) -> None:
                 return
 
             # Edit wpa supplicant config with new mesh freq
-            conf = re.sub(r'frequency=\d*', f'frequency={starting_frequency}', conf)
+            conf = util.FREQ_RE.sub(f'frequency={starting_frequency}', conf)
 
             # Write edited config back to file
             util.write_file('/var/run/wpa_supplicant-11s.conf', conf, 'Failed to write wpa supplicant config')
@@ -70,7 +70,7 @@ def switch_frequency(args) -> None:
             util.run_command('iw dev', 'Failed to run iw dev')
 
             # Validate outcome of switch frequency process
-            mesh_freq = util.get_mesh_freq()
+            mesh_freq = util.get_mesh_freq(args.mesh_interface)
             if mesh_freq != int(starting_frequency):
                 if num_switch_freq_retries < max_retries:
                     print("Frequency switch unsuccessful... retrying") if args.debug else None
@@ -156,6 +156,7 @@ def start_scripts(args, osf_ipv6_address):
 
 def main():
     args = Options()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
 
     # Set up tun0 interface for OSF
     print("1. set up tun0 osf interface") if args.debug else None
@@ -163,7 +164,7 @@ def main():
 
     # Switch to starting frequency
     print("2. switch to starting frequency") if args.debug else None
-    mesh_freq = util.get_mesh_freq()
+    mesh_freq = util.get_mesh_freq(args.mesh_interface)
     if mesh_freq == np.nan or util.map_channel_to_freq(args.starting_channel) != mesh_freq:
         switch_frequency(args)
 
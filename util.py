@@ -1,17 +1,33 @@
+import ctypes
+import ctypes.util
+import functools
+import logging
+import os
 import re
+import shlex
+import struct
 import subprocess
+from pathlib import Path
+from typing import Optional
 
 import netifaces
-import numpy as np
 
 from options import Options
 args = Options()
+logger = logging.getLogger(__name__)
 
-CH_TO_FREQ = {1: 2412, 2: 2417, 3: 2422, 4: 2427, 5: 2432, 6: 2437, 7: 2442, 8: 2447, 9: 2452, 10: 2457, 11: 2462,
-              36: 5180, 40: 5200, 44: 5220, 48: 5240, 52: 5260, 56: 5280, 60: 5300, 64: 5320, 100: 5500, 104: 5520,
-              108: 5540, 112: 5560, 116: 5580, 120: 5600, 124: 5620, 128: 5640, 132: 5660, 136: 5680, 140: 5700,
-              149: 5745, 153: 5765, 157: 5785, 161: 5805}
-FREQ_TO_CH = {v: k for k, v in CH_TO_FREQ.items()}
+# Header of the messages exchanged between server and clients: payload length as a 4-byte big-endian integer
+FRAME_HEADER = struct.Struct('!I')
+
+# inotify events signalling a file was written or moved into a watched directory, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# Interface name and channel frequency of each interface section of `iw dev`
+IW_RE = re.compile(r'Interface\s+(\S+)(?:(?!Interface\s).)*?channel\s+\d+\s+\((\d+)\s*MHz\)', re.DOTALL)
+
+# frequency= line of the wpa_supplicant mesh config
+FREQ_RE = re.compile(r'frequency=\d*')
 
 
 def map_freq_to_channel(freq: int) -> int:
@@ -19,65 +35,54 @@ def map_freq_to_channel(freq: int) -> int:
     Maps the given frequency to its corresponding channel number int.
 
     :param freq: The frequency value.
-    :return: The frequency.
+    :return: The channel number.
     """
-    return FREQ_TO_CH[freq]
+    # 2.4 GHz channels are 5 MHz apart from 2407 MHz, 5 GHz channels from 5000 MHz
+    if 2412 <= freq <= 2472 and freq % 5 == 2:
+        return (freq - 2407) // 5
+    if 5160 <= freq <= 5885 and freq % 5 == 0:
+        return (freq - 5000) // 5
+    raise ValueError(f"No channel for frequency {freq} MHz")
 
 
+@functools.lru_cache(maxsize=4)
 def get_ipv6_addr(osf_interface) -> str:
     """
-    Get the IPv6 address of the OSF network interface.
+    Get the IPv6 address of the OSF network interface, the result is cached per interface.
 
     :param osf_interface: The name of the network interface.
     :return: The IPv6 address as a string.
     """
     # Retrieve the IPv6 addresses associated with the osf_interface
     ipv6_addresses = netifaces.ifaddresses(osf_interface).get(netifaces.AF_INET6, [])
-    if ipv6_addresses:
-        for addr_info in ipv6_addresses:
-            if 'addr' in addr_info and addr_info['addr'].startswith('fd'):
-                return addr_info['addr']
-            else:
-                return None
-    else:
-        return None
+    for addr_info in ipv6_addresses:
+        addr = addr_info.get('addr', '')
+        if addr.startswith('fd'):
+            return addr
+    return None
 
 
-def get_mesh_freq() -> int:
+def get_mesh_freq(mesh_interface: str = args.mesh_interface, iw_output: Optional[str] = None) -> int:
     """
     Get the mesh frequency of the device.
 
+    :param mesh_interface: The name of the mesh network interface.
+    :param iw_output: Output of `iw dev` already captured by the caller, `iw dev` is run when not given.
     :return: An integer representing the mesh frequency.
     """
-    mesh_freq: int = np.nan
+    mesh_freq: int = float('nan')
 
     try:
-        iw_output = subprocess.check_output(['iw', 'dev'], encoding='utf-8')
-        iw_output = re.sub('\s+', ' ', iw_output).split(' ')
-
-        # Extract interface sections from iw_output
-        idx_list = [idx - 1 for idx, val in enumerate(iw_output) if val == "Interface"]
-        if len(idx_list) > 1:
-            idx_list.pop(0)
-
-        # Calculate the start and end indices for interface sections
-        start_indices = [0] + idx_list
-        end_indices = idx_list + ([len(iw_output)] if idx_list[-1] != len(iw_output) else [])
-
-        # Use zip to create pairs of start and end indices, and extract interface sections
-        iw_interfaces = [iw_output[start:end] for start, end in zip(start_indices, end_indices)]
-
-        # Check if mesh interface is up and get freq
-        for interface_list in iw_interfaces:
-            try:
-                if "mesh" in interface_list:
-                    channel_index = interface_list.index("channel") + 2
-                    mesh_freq = int(re.sub("[^0-9]", "", interface_list[channel_index]).split()[0])
-                    break
-            except Exception as e:
-                print(f"Get mesh freq exception: {e}") if args.debug else None
+        if iw_output is None:
+            iw_output = subprocess.check_output(['iw', 'dev'], encoding='utf-8')
+
+        # Get the channel frequency of the mesh interface section
+        for match in IW_RE.finditer(iw_output):
+            if match.group(1) == mesh_interface:
+                mesh_freq = int(match.group(2))
+                break
     except Exception as e:
-        print(f"Get mesh freq exception: {e}") if args.debug else None
+        logger.debug("Get mesh freq exception: %s", e)
 
     return mesh_freq
 
@@ -89,24 +94,30 @@ def map_channel_to_freq(channel: int) -> int:
     :param channel: The channel number.
     :return: The frequency.
     """
-    return CH_TO_FREQ[channel]
+    if 1 <= channel <= 13:
+        return 2407 + 5 * channel
+    if 32 <= channel <= 177:
+        return 5000 + 5 * channel
+    raise ValueError(f"No frequency for channel {channel}")
 
 
 # Frequency switch related functions
 def run_command(command, error_message) -> None:
     """
-    Execute a shell command and check for success.
+    Execute a command without a shell and check for success.
 
-    param command: The shell command to execute.
+    param command: The command to execute, as a string split with shell-like syntax or as an argument list.
     param error_message: Error message to display if the command fails.
 
     return: True if the command was successful, False otherwise.
     """
+    argv = shlex.split(command) if isinstance(command, str) else command
     try:
-        if args.debug:
-            subprocess.call(command, shell=True)
+        # Show the command output only when debug logging is enabled from the parsed options
+        if logger.isEnabledFor(logging.DEBUG):
+            subprocess.run(argv, check=False)
         else:
-            subprocess.call(command, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.DEVNULL)
+            subprocess.run(argv, stderr=subprocess.STDOUT, stdout=subprocess.DEVNULL, check=False)
     except Exception as e:
         error_message = f"Error occurred: {error_message}"
         raise Exception(error_message) from e
@@ -122,26 +133,39 @@ def read_file(filename, error_message):
     return: The content of the file as a string, or None if an error occurs.
     """
     try:
-        with open(filename, 'r') as f:
-            return f.read()
+        return Path(filename).read_text()
     except Exception as e:
-        print(f"Error occurred while reading {filename}: {error_message}. Exception: {str(e)}") if args.debug else None
+        logger.debug("Error occurred while reading %s: %s. Exception: %s", filename, error_message, e)
         return None
 
 
-def write_file(filename, content, error_message) -> None:
+def write_file(filename, content, error_message) -> bool:
     """
-    Write content to a file.
+    Atomically write content to a file, by writing a temporary file and renaming it over the original.
 
     param filename: Name of the file to write to.
     param content: The content to write to the file.
     param error_message: Error message to display if writing to the file fails.
+
+    return: True if the file was written, False otherwise.
     """
+    tmp_filename = filename + '.tmp'
     try:
-        with open(filename, 'w') as f:
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
             f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+        return True
     except Exception as e:
-        print(f"Error occurred while writing {filename}: {error_message}. Exception: {str(e)}") if args.debug else None
+        logger.debug("Error occurred while writing %s: %s. Exception: %s", filename, error_message, e)
+        # Do not leave a partially written temporary file behind
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        return False
 
 
 def is_process_running(process_name):
@@ -153,11 +177,44 @@ def is_process_running(process_name):
     return: True if the process is running, False otherwise.
     """
     try:
-        process_list = subprocess.check_output(['ps', 'aux']).decode('utf-8').split('\n')
-        for process in process_list:
-            if process_name in process:
-                return True
+        # Scan the command lines of the running processes in /proc
+        name = process_name.encode()
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    if name in f.read():
+                        return True
+            except OSError:
+                # Process exited while scanning
+                continue
         return False
     except Exception as e:
-        print(f"Error occurred while checking process: {str(e)}") if args.debug else None
+        logger.debug("Error occurred while checking process: %s", e)
         return False
+
+
+def watch_file(filename) -> Optional[int]:
+    """
+    Watch a file for changes with inotify. The parent directory is watched so that files replaced by editors are still seen.
+
+    param filename: Name of the file to watch.
+
+    return: A non-blocking inotify file descriptor that becomes readable when the file may have changed, or None if
+    inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        directory = os.path.dirname(os.path.abspath(filename))
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f'inotify_add_watch failed for {directory}')
+        return fd
+    except (OSError, AttributeError) as e:
+        logger.debug("Error occurred while watching %s: %s", filename, e)
+        return None